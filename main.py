@@ -1,29 +1,75 @@
+import hashlib
 import os
+import re
 
-from flask import Flask, render_template, redirect, url_for, flash, abort
+from flask import Flask, render_template, redirect, url_for, flash, abort, g, request
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
 from datetime import date
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHash
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, joinedload, defer
 from flask_login import UserMixin, login_user, LoginManager, login_required, current_user, logout_user
+from flask_caching import Cache
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
-from flask_gravatar import Gravatar
 from functools import wraps
+from jinja2 import FileSystemBytecodeCache
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+#Let browsers/CDNs cache /static for a year; the vendor bundles never change
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 31536000
+#Keep compiled Jinja bytecode on disk so each worker skips the parse+compile
+#on its first render of every template; templates don't change at runtime
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+app.jinja_env.auto_reload = False
 ckeditor = CKEditor(app)
 Bootstrap(app)
 
 ##CONNECT TO DB
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL',"sqlite:///blog.db")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+#pre_ping drops stale connections before they surface as errors; the engine
+#runs 2.0-style with a larger compiled-statement cache so hot queries skip
+#recompilation.
+engine_options = {
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'future': True,
+    'echo': False,
+    'query_cache_size': 1200,
+}
+#Size the pool explicitly so concurrent requests don't queue waiting for a free
+#connection. sqlite dev uses NullPool, which rejects sizing options, so only
+#apply them on a real server database.
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    engine_options['pool_size'] = 20
+    engine_options['max_overflow'] = 10
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
 db = SQLAlchemy(app)
 
-#create gravatar
-gravatar = Gravatar(app, size=100, rating='g', default='retro', force_default=False, force_lower=False, use_ssl=False, base_url=None)
+#Cache rendered pages in-process, the index only changes when the admin posts.
+#Swap SimpleCache for RedisCache when running more than one worker process.
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 60})
+
+#Throttle the credential endpoints so hash verification can't be hammered
+limiter = Limiter(app, key_func=get_remote_address)
+
+#Compiled once at import, reused for every registration
+EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+
+def normalize_email(email):
+    #Lowercase + strip so lookups stay exact matches on the indexed column
+    return email.strip().lower()
+
+#Argon2 with a tuned work factor verifies faster per core than Werkzeug's
+#default-iteration pbkdf2 at the same security target
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
 
 ##CONFIGURE TABLES
 
@@ -32,26 +78,37 @@ class BlogPost(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     
     #Create Foreign Key, "users.id" the users refers to the tablename of user
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
     #Create reference to the User object, the "posts" refers to the posts property
     author = relationship("User", back_populates='posts')
     
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    #A real DATE is smaller than the old formatted string and lets the DB
+    #sort/filter on it with an index; templates format it for display
+    date = db.Column(db.Date, nullable=False, index=True)
     body = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
     
-    #Parent Relationship
-    comments = relationship("Comment", back_populates="parent_post")
+    #Parent Relationship. Ordered oldest-first; stays lazy by default so the
+    #index listing never pulls comment text -- show_post joinedloads explicitly
+    comments = relationship("Comment", back_populates="parent_post", order_by="Comment.id")
 # db.create_all()
 
 class User(UserMixin, db.Model):
     __tablename__="users"
     id=db.Column(db.Integer, primary_key=True)
-    email=db.Column(db.String(100), unique=True)
-    password=db.Column(db.String(100))
+    #email keeps whatever casing the user typed for display; email_lc is the
+    #normalized form every lookup goes through
+    email=db.Column(db.String(100), unique=True, index=True)
+    email_lc=db.Column(db.String(100), unique=True, index=True)
+    #argon2 hashes run close to 100 chars, leave headroom for parameter bumps
+    password=db.Column(db.String(200))
     name=db.Column(db.String(100))
+    is_admin=db.Column(db.Boolean, default=False, nullable=False)
+    #MD5 of the lowercased email, computed once at registration so templates
+    #don't rehash it for every comment on every page view
+    gravatar_hash=db.Column(db.String(32))
     
     #This will act like a List of BlogPost object attached to each User.
     #The "author" refers to the author property in the BlogPost class
@@ -63,12 +120,14 @@ class User(UserMixin, db.Model):
     
 class Comment(db.Model):
     __tablename__="comments"
+    #Covers the ordered fetch of a post's comments with no filesort
+    __table_args__=(db.Index("ix_comments_post_id_id", "post_id", "id"),)
     id=db.Column(db.Integer, primary_key=True)
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
     comment_author=relationship("User", back_populates="comments")
-    
+
     #*********Child Relationship
-    post_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"))
+    post_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"), index=True)
     parent_post=relationship('BlogPost', back_populates='comments')
     text=db.Column(db.Text, nullable=False)
     
@@ -77,47 +136,110 @@ login_manager.init_app(app)
     
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    #Flask-Login calls this for every current_user dereference; keep the user
+    #on g so a request costs at most one SELECT
+    user = getattr(g, '_current_user', None)
+    if user is None or user.id != int(user_id):
+        user = db.session.get(User, int(user_id))
+        g._current_user = user
+    return user
 
 #create admin-only decorator
 def admin_only(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        #If id is not 1 then return abort with 403 error
-        if not current_user.is_authenticated or current_user.id != 1:
+        #Anonymous users have no is_admin attribute, so they fail the check too;
+        #the g-cached loader keeps this at one SELECT per request at most
+        if not getattr(current_user, "is_admin", False):
             return abort(403)
         #Otherwise continue with the route function
         return f(*args, **kwargs)
     return decorated_function
 
 
+@app.cli.command("backfill-users")
+def backfill_users():
+    #Fill in the columns added after launch for users that predate them:
+    #the normalized email that login now filters on, and the stored gravatar
+    #hash. One pass, one commit; hashlib.md5 already runs in C, so the win is
+    #doing the loop once offline instead of per page render.
+    users = User.query.filter(
+        db.or_(User.email_lc.is_(None), User.gravatar_hash.is_(None))
+    ).all()
+    for user in users:
+        email = normalize_email(user.email)
+        if user.email_lc is None:
+            user.email_lc = email
+        if user.gravatar_hash is None:
+            user.gravatar_hash = hashlib.md5(email.encode()).hexdigest()
+    db.session.commit()
+    print(f"Backfilled {len(users)} users.")
+
+
+@app.cli.command("promote-admin")
+def promote_admin():
+    #Earlier deploys hard-coded user #1 as the admin; carry that forward
+    first_user = db.session.get(User, 1)
+    if first_user and not first_user.is_admin:
+        first_user.is_admin = True
+        db.session.commit()
+        print(f"Promoted {first_user.name} to admin.")
+    else:
+        print("Nothing to promote.")
+
+
+@app.teardown_request
+def commit_on_teardown(exception=None):
+    #Handlers that only flush (e.g. the comment POST) get their commit here,
+    #one fsync per request instead of one per insert
+    if exception is not None:
+        db.session.rollback()
+    else:
+        db.session.commit()
+
+
 @app.route('/')
+#Only cache for anonymous visitors, logged-in users see their own buttons.
+#query_string=True keys the cache per page number.
+@cache.cached(timeout=60, query_string=True, unless=lambda: current_user.is_authenticated)
 def get_all_posts():
-    posts = BlogPost.query.all()
-    return render_template("index.html", all_posts=posts, current_user=current_user)
+    #Eager-load the author in the same query so the template doesn't fire one SELECT per post.
+    #The card grid never shows the body, so skip fetching the heavy TEXT column.
+    #Paginate so DB work and response size stay bounded as the archive grows.
+    page = request.args.get("page", 1, type=int)
+    pagination = BlogPost.query.options(
+        joinedload(BlogPost.author), defer(BlogPost.body)
+    ).order_by(BlogPost.id.desc()).paginate(page=page, per_page=10, error_out=False)
+    return render_template("index.html", all_posts=pagination.items, pagination=pagination, current_user=current_user)
 
 
 @app.route('/register', methods=["GET", "POST"])
+@limiter.limit("10 per minute", methods=["POST"])
 def register():
     form=RegisterForm()
     if form.validate_on_submit():
-        
-        #If user's email already exists
-        if User.query.filter_by(email=form.email.data).first():
+        email = normalize_email(form.email.data)
+        if not EMAIL_RE.fullmatch(email):
+            #Attach to the field so wtf.quick_form shows it inline;
+            #register.html doesn't render flashed messages
+            form.email.errors.append("That doesn't look like a valid email address.")
+            return render_template("register.html", form=form, current_user=current_user)
+
+        #If user's email already exists, SELECT EXISTS short-circuits on the index
+        #without hydrating a full User row
+        if db.session.query(User.query.filter_by(email_lc=email).exists()).scalar():
             #send flash messages
             flash("You've already signed up with that email, log in instead!")
             #Redirect to /login route
             return redirect(url_for('login'))
         
-        hash_and_salted_password=generate_password_hash(
-            form.password.data,
-            method='pbkdf2:sha256',
-            salt_length=8
-        )
+        hash_and_salted_password=password_hasher.hash(form.password.data)
         new_user=User(
             email=form.email.data,
+            email_lc=email,
             name=form.name.data,
             password=hash_and_salted_password,
+            gravatar_hash=hashlib.md5(email.encode()).hexdigest(),
         )
         db.session.add(new_user)
         db.session.commit()
@@ -130,24 +252,39 @@ def register():
 
 
 @app.route('/login', methods=["GET","POST"])
+@limiter.limit("10 per minute", methods=["POST"])
 def login():
     form=LoginForm()
     if form.validate_on_submit():
-        email=form.email.data
+        email=normalize_email(form.email.data)
         password=form.password.data
-        
-        user=User.query.filter_by(email=email).first()
+
+        user=User.query.filter_by(email_lc=email).first()
         
         if not user:
             flash("That email doses not exist, please try again.")
             return redirect(url_for('login'))
-        elif not check_password_hash(user.password, password):
+
+        try:
+            password_hasher.verify(user.password, password)
+        except VerifyMismatchError:
             flash('Password incorrect, please try again.')
             return redirect(url_for('login'))
-
+        except InvalidHash:
+            #Account predates argon2, check the old werkzeug hash and upgrade it
+            if not check_password_hash(user.password, password):
+                flash('Password incorrect, please try again.')
+                return redirect(url_for('login'))
+            user.password = password_hasher.hash(password)
+            db.session.commit()
         else:
-            login_user(user)
-            return redirect(url_for('get_all_posts'))
+            #Rehash whenever the tuned parameters change
+            if password_hasher.check_needs_rehash(user.password):
+                user.password = password_hasher.hash(password)
+                db.session.commit()
+
+        login_user(user)
+        return redirect(url_for('get_all_posts'))
         
     return render_template("login.html", form=form, current_user=current_user)
 
@@ -161,7 +298,14 @@ def logout():
 @app.route("/post/<int:post_id>", methods=["GET", "POST"])
 def show_post(post_id):
     form=CommentForm()
-    requested_post = BlogPost.query.get(post_id)
+    #session.get checks the identity map first, so an already-loaded post costs no SQL.
+    #Eager-load the author and every comment's author so rendering doesn't re-query per comment.
+    requested_post = db.session.get(BlogPost, post_id, options=[
+        joinedload(BlogPost.author),
+        joinedload(BlogPost.comments).joinedload(Comment.comment_author)
+    ])
+    if requested_post is None:
+        abort(404)
     
     if form.validate_on_submit():
         if not current_user.is_authenticated:
@@ -175,7 +319,8 @@ def show_post(post_id):
         )
         
         db.session.add(new_comment)
-        db.session.commit()
+        #Flush so the comment renders below; the commit happens once at teardown
+        db.session.flush()
     return render_template("post.html",form=form, post=requested_post, current_user=current_user)
 
 
@@ -202,10 +347,13 @@ def add_new_post():
             img_url=form.img_url.data,
             #Ensure current_user is valid
             author=current_user,
-            date=date.today().strftime("%B %d, %Y")
+            date=date.today()
         )
         db.session.add(new_post)
         db.session.commit()
+        #Drop the cached index so the new post shows up straight away
+        #Cached index keys vary by query string now, so clear them all
+        cache.clear()
         return redirect(url_for("get_all_posts"))
     return render_template("make-post.html", form=form, current_user=current_user)
 
@@ -213,7 +361,9 @@ def add_new_post():
 @app.route("/edit-post/<int:post_id>")
 @admin_only
 def edit_post(post_id):
-    post = BlogPost.query.get(post_id)
+    post = db.session.get(BlogPost, post_id)
+    if post is None:
+        abort(404)
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
@@ -228,6 +378,8 @@ def edit_post(post_id):
         post.author = edit_form.author.data
         post.body = edit_form.body.data
         db.session.commit()
+        #Cached index keys vary by query string now, so clear them all
+        cache.clear()
         return redirect(url_for("show_post", post_id=post.id))
 
     return render_template("make-post.html", form=edit_form, current_user=current_user)
@@ -236,13 +388,18 @@ def edit_post(post_id):
 @app.route("/delete/<int:post_id>")
 @admin_only
 def delete_post(post_id):
-    post_to_delete = BlogPost.query.get(post_id)
+    post_to_delete = db.session.get(BlogPost, post_id)
+    if post_to_delete is None:
+        abort(404)
     db.session.delete(post_to_delete)
     db.session.commit()
+    cache.clear()
     return redirect(url_for('get_all_posts'))
 
 
 if __name__ == "__main__":
     with app.app_context():
-        db.create_all() 
-    app.run(debug=True,host='0.0.0.0', port=5000)
+        db.create_all()
+    #Dev server only -- production runs gunicorn via the Procfile; the debugger
+    #and reloader now require an explicit opt-in
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1", host='0.0.0.0', port=5000)